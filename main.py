@@ -1,22 +1,40 @@
-import sys
 import os
 import re
-import datetime
+import functools
+import argparse
+import concurrent.futures
 import pypdf
 import pandas
 
-from typing import Any, Callable, Generator, Sequence
+from typing import Any, Callable, Generator, Literal, Sequence
 
 
 ################################################################################
 # Functions
 
+def match_to_dict(match: re.Match) -> dict[str, str]:
+    return {key: value for key, value in match.groupdict().items()
+        if value is not None}
+
+
 def search_to_dict(pattern: re.Pattern, string: str) -> dict[str, str]:
     match = pattern.search(string)
     if match is None:
         raise ValueError("No Match!")
     else:
-        return match.groupdict()
+        return match_to_dict(match)
+
+
+def search_fields(patterns: dict[str, re.Pattern], string: str) -> dict[str, str]:
+    # Search each field in order, starting from the end of the previous one
+    pairs, position = {}, 0
+    for key, pattern in patterns.items():
+        match = pattern.search(string, position)
+        if match is None:
+            raise ValueError("No Match!")
+        pairs[key] = match.group(1)
+        position = match.end()
+    return pairs
 
 
 def str_add_apostrophe(string: str | Any) -> str | Any:
@@ -25,46 +43,32 @@ def str_add_apostrophe(string: str | Any) -> str | Any:
     else:
         return string
 
-def date_from_iso_format(date: str | datetime.date | Any) -> datetime.date | Any:
-    if isinstance(date, datetime.date):
-        return date
-    elif not sys.version_info >= (3, 11) and len(date) == 8:
-        return datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8]))
-    else:
-        return datetime.date.fromisoformat(date)
-
-
-def convert_type(pairs: dict[str, Any],
-    conversions: dict[Callable, Sequence[str]]
-) -> None:
-    for type_, keys in conversions.items():
-        for key in keys:
-            value = pairs.get(key)
-            if value is not None:
-                pairs[key] = type_(value)
-            else:
-                pairs.pop(key, None)
-
 
 ################################################################################
 # Check and Substitute
 
+CHECK_STRINGS: tuple[str, ...] = ("中国南方电网公司", "电费通知单")
 CHECK_PATTERN: re.Pattern = re.compile(
-    r"中国南方电网公司 ?\w+电网公司 ?电费通知单", flags=re.DOTALL)
+    r"中国南方电网公司 ?\w+电网公司 ?电费通知单")
 
-def check_text(pattern: re.Pattern, text: str) -> bool:
-    # For Excel
+def check_text(pattern: re.Pattern, text: str, strings: Sequence[str] = ()
+) -> bool:
+    # Substring tests reject most other pages before the pattern is searched
+    if not all(string in text for string in strings):
+        return False
     return True if pattern.search(text) is not None else False
 
 
-SUBSTITUTION_PATTERNS_REPLACEMENTS: tuple[tuple[re.Pattern, str]] = (
+SUBSTITUTION_PATTERNS_REPLACEMENTS: tuple[tuple[re.Pattern, str], ...] = (
     (re.compile(r" {2,}"), ' '),
     (re.compile(r"(\d+SG\d+)\n(\d+) ?"), r"\1\2 "), # 表计资产编号
-    (re.compile(r" ?(\(\d+\))?([\w/]+)(\([\w/]+\))?\n ?(\([\w/]+\)|电量)"), 
+    (re.compile(r" ?(\(\d+\))?([\w/]+)(\([\w/]+\))?\n ?(\([\w/]+\)|电量)"),
         r" \1\2\3\4"), # 电量\n\(千瓦时\)
 )
 
-def substitute_text(patterns_repls: re.Pattern, text: str) -> str:
+def substitute_text(
+    patterns_repls: tuple[tuple[re.Pattern, str], ...], text: str
+) -> str:
     for pattern, replacement in patterns_repls:
         text = pattern.sub(replacement, text)
     return text
@@ -73,47 +77,38 @@ def substitute_text(patterns_repls: re.Pattern, text: str) -> str:
 ################################################################################
 # Extract 基本信息 Basic information
 
-INFORMATION_PATTERN: re.Pattern = re.compile((
+INFORMATION_PATTERNS: dict[str, re.Pattern] = {
     # 中国南方电网公司 电网公司 电费通知单
-    r"尊敬的： ?"     r"(?P<用户>\w+).*"
-    r"用户编号： ?"   r"(?P<用户编号>\d+).*"
-    r"结算户号： ?"   r"(?P<结算户号>\d+).*"
-    r"结算户名： ?"   r"(?P<结算户名>\w+).*"
-    r"计量点编号： ?" r"(?P<计量点编号>\d+).*"
+    "用户":       re.compile(r"尊敬的： ?(\w+)"),
+    "用户编号":   re.compile(r"用户编号： ?(\d+)"),
+    "结算户号":   re.compile(r"结算户号： ?(\d+)"),
+    "结算户名":   re.compile(r"结算户名： ?(\w+)"),
+    "计量点编号": re.compile(r"计量点编号： ?(\d+)"),
     # 基本信息 Basic information
-    r"市场化属性分类： ?" r"(?P<市场化属性分类>\w+).*"
-    r"用电类别： ?"       r"(?P<用电类别>\w+).*"
-    r"用电开始时间： ?"   r"(?P<用电开始时间>\d+).*"
-    r"用电结束时间： ?"   r"(?P<用电结束时间>\d+)"
-), flags=re.DOTALL)
+    "市场化属性分类": re.compile(r"市场化属性分类： ?(\w+)"),
+    "用电类别":       re.compile(r"用电类别： ?(\w+)"),
+    "用电开始时间":   re.compile(r"用电开始时间： ?(\d+)"),
+    "用电结束时间":   re.compile(r"用电结束时间： ?(\d+)")}
 
-INFORMATION_CONVERSIONS: dict[Callable, tuple[str]] = {
-    str_add_apostrophe: ("用户编号", "结算户号", "计量点编号"),
-    date_from_iso_format: ("用电开始时间", "用电结束时间")}
+# Parsed for all bills at once, see convert_bills
+INFORMATION_DATES: tuple[str, ...] = ("用电开始时间", "用电结束时间")
 
 def extract_information(text: str) -> dict[str, str | Any]:
-    information = search_to_dict(INFORMATION_PATTERN, text)
-    convert_type(information, INFORMATION_CONVERSIONS)
-    return information
+    return search_fields(INFORMATION_PATTERNS, text)
 
 
 ################################################################################
 # Extract 电量信息 Electricity Consumption Details
 
-CONSUMPTION_非分时_ITEMS: tuple[str] = ("有功总", "无功总")
-CONSUMPTION_分时_ITEMS: tuple[str] = ("尖", "峰", "平", "谷", "无功总")
-
-CONSUMPTION_非分时_CHECK_PATTERN: re.Pattern = re.compile(
-    r".*".join(CONSUMPTION_非分时_ITEMS), flags=re.DOTALL)
-CONSUMPTION_分时_CHECK_PATTERN: re.Pattern = re.compile(
-    r".*".join(CONSUMPTION_分时_ITEMS), flags=re.DOTALL)
+CONSUMPTION_非分时_ITEMS: tuple[str, ...] = ("有功总", "无功总")
+CONSUMPTION_分时_ITEMS: tuple[str, ...] = ("尖", "峰", "平", "谷", "无功总")
 
-CONSUMPTION_PATTERN_STR_ITEMS: tuple[str] = (
+CONSUMPTION_PATTERN_STR_ITEMS: tuple[str, ...] = (
     r"[\d\.-]+", r"\(千瓦时\)", *CONSUMPTION_非分时_ITEMS, "表计资产编号",
     "上次表示数", "本次表示数", "倍率", "抄见电量", "换表电量", "退补电量",
     "变线损电量", "公摊电量", "免费电量", "分表电量", "尖峰调整电量", "合计电量")
 
-CONSUMPTION_非分时_PATTERN: re.Pattern = re.compile((
+CONSUMPTION_非分时_PATTERN_STR: str = (
     # 电量信息 Electricity Consumption Details
     r"{4} ?示数类型 ?{5} ?{6} ?{7} ?{8}{1} ?{9}{1} ?{10}{1} ?"
     r"变/线损电量(?:{1})? ?{12}{1} ?{13}{1} ?{14}{1} ?{16}{1}\n"
@@ -125,9 +120,9 @@ CONSUMPTION_非分时_PATTERN: re.Pattern = re.compile((
     r"(?P<{3}{4}>\d+SG\d+) {3} (?P<{3}{5}>{0}) (?P<{3}{6}>{0}) (?P<{3}{7}>{0}) "
     r"(?P<{3}{8}>{0}) (?P<{3}{9}>{0}) (?P<{3}{10}>{0}) (?P<{3}{11}>{0}) "
     r"(?P<{3}{12}>{0}) (?P<{3}{14}>{0}) (?P<{3}{16}>{0})\n"
-).format(*CONSUMPTION_PATTERN_STR_ITEMS), flags=re.DOTALL)
+).format(*CONSUMPTION_PATTERN_STR_ITEMS)
 
-CONSUMPTION_分时_PATTERN: re.Pattern = re.compile((
+CONSUMPTION_分时_PATTERN_STR: str = (
     # 电量信息 Electricity Consumption Details
     r"{4} ?示数类型 ?{5} ?{6} ?{7} ?{8}{1} ?{9}{1} ?{10}{1} ?"
     r"变/线损电量(?:{1})? ?{12}{1} ?{13}{1} ?{14}{1}(?: ?{15}(?:{1})?)? ?{16}{1}\n"
@@ -151,34 +146,42 @@ CONSUMPTION_分时_PATTERN: re.Pattern = re.compile((
     r"(?P<{3}{4}>\d+SG\d+) {3} (?P<{3}{5}>{0}) (?P<{3}{6}>{0}) "
     r"(?P<{3}{7}>{0}) (?P<{3}{8}>{0}) (?P<{3}{9}>{0}) (?P<{3}{10}>{0}) "
     r"(?P<{3}{11}>{0}) (?P<{3}{12}>{0}) (?P<{3}{14}>{0}) (?P<{3}{16}>{0})\n"
-).format(*CONSUMPTION_PATTERN_STR_ITEMS), flags=re.DOTALL)
+).format(*CONSUMPTION_PATTERN_STR_ITEMS)
 
-CONSUMPTION_CONVERSIONS: dict[Callable, tuple[str]] = {
+# Compiled on first use, a corpus may contain only one kind of bill
+@functools.cache
+def consumption_非分时_pattern() -> re.Pattern:
+    return re.compile(CONSUMPTION_非分时_PATTERN_STR)
+
+@functools.cache
+def consumption_分时_pattern() -> re.Pattern:
+    return re.compile(CONSUMPTION_分时_PATTERN_STR)
+
+CONSUMPTION_CONVERSIONS: dict[Callable, tuple[str, ...]] = {
     int: CONSUMPTION_PATTERN_STR_ITEMS[7:8],
     float: (*CONSUMPTION_PATTERN_STR_ITEMS[5:7],
         *CONSUMPTION_PATTERN_STR_ITEMS[8:])}
 
-CONSUMPTION_非分时_CONVERSIONS: dict[Callable, tuple[str]] = {
+CONSUMPTION_非分时_CONVERSIONS: dict[Callable, tuple[str, ...]] = {
     t: tuple(item+key for item in CONSUMPTION_非分时_ITEMS for key in keys)
     for t, keys in CONSUMPTION_CONVERSIONS.items()}
 
-CONSUMPTION_分时_CONVERSIONS: dict[Callable, tuple[str]] = {
+CONSUMPTION_分时_CONVERSIONS: dict[Callable, tuple[str, ...]] = {
     t: tuple(item+key for item in CONSUMPTION_分时_ITEMS for key in keys)
     for t, keys in CONSUMPTION_CONVERSIONS.items()}
 
 def extract_consumption(text: str) -> dict[str, str | Any]:
-    if CONSUMPTION_非分时_CHECK_PATTERN.search(text) is not None:
-        consumption = search_to_dict(CONSUMPTION_非分时_PATTERN, text)
+    # Substring tests skip a pattern whose 示数类型 are absent, a 非分时
+    # search that fails falls back to 分时
+    match = consumption_非分时_pattern().search(text) \
+        if all(item in text for item in CONSUMPTION_非分时_ITEMS) else None
+    if match is not None:
+        consumption = match_to_dict(match)
         consumption["表计资产编号"] = consumption["有功总表计资产编号"]
-        convert_type(consumption, CONSUMPTION_非分时_CONVERSIONS)
 
-    elif CONSUMPTION_分时_CHECK_PATTERN.search(text) is not None:
-        consumption = search_to_dict(CONSUMPTION_分时_PATTERN, text)
+    elif all(item in text for item in CONSUMPTION_分时_ITEMS):
+        consumption = search_to_dict(consumption_分时_pattern(), text)
         consumption["表计资产编号"] = consumption["平表计资产编号"]
-        consumption["有功总合计电量"] = sum(
-            float(consumption[示数类型+"合计电量"])
-            for 示数类型 in CONSUMPTION_分时_ITEMS[:-1])
-        convert_type(consumption, CONSUMPTION_分时_CONVERSIONS)
 
     else:
         raise ValueError("Unknown 用电类别!")
@@ -188,65 +191,176 @@ def extract_consumption(text: str) -> dict[str, str | Any]:
 ################################################################################
 # Extract 电费信息 Electricity Bill Information
 
-BILL_PATTERN: re.Pattern = re.compile((
+BILL_PATTERNS: dict[str, re.Pattern] = {
     # 电费信息 Electricity Bill Information
-    r"应收电费合计（大写）： ?(?P<应收电费合计大写>\w+) ?元?.*"
-    r"应收电费合计（小写）： ?(?P<应收电费合计>[\d\.]+) ?元.*"
-    r"平均电价： ?(?P<平均电价>[\d\.]+) ?\(元/千瓦时\)"
-), re.DOTALL)
+    "应收电费合计大写": re.compile(r"应收电费合计（大写）： ?(\w+)"),
+    "应收电费合计":     re.compile(r"应收电费合计（小写）： ?([\d\.]+) ?元"),
+    "平均电价":         re.compile(r"平均电价： ?([\d\.]+) ?\(元/千瓦时\)")}
 
-BILL_CONVERSIONS: dict[Callable, tuple[str]] = {
+BILL_CONVERSIONS: dict[Callable, tuple[str, ...]] = {
     float: ("应收电费合计", "平均电价")}
 
 def extract_bill(text: str) -> dict[str, str | Any]:
-    bill = search_to_dict(BILL_PATTERN, text)
-    convert_type(bill, BILL_CONVERSIONS)
-    return bill
+    return search_fields(BILL_PATTERNS, text)
 
 
 ################################################################################
 # Read and Extract
 
+def read_pages(file_path: str) -> Generator[str, None, None]:
+    for page in pypdf.PdfReader(file_path).pages:
+        yield page.extract_text()
+
+def load_pdf(file_path: str) -> list[dict[str, str | Any]]:
+    # Worker, must stay at module level to be picklable
+    bills = []
+    for text in read_pages(file_path):
+        bill = extract(text)
+        if bill is not None:
+            bills.append(bill)
+    return bills
+
+def find_pdfs(directory: str) -> Generator[str, None, None]:
+    # Like os.walk, unreadable directories are skipped and links not followed
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from find_pdfs(entry.path)
+        elif entry.name.endswith('.pdf') and entry.is_file():
+            yield entry.path
+
 def load(directory: str) -> Generator[dict[str, str | Any], None, None]:
-    for path, dirs_name, files_name in os.walk(directory):
-        for file_name in files_name:
-            if os.path.splitext(file_name)[-1] == '.pdf':
-                for page in pypdf.PdfReader(os.path.join(path, file_name)).pages:
-                    bill = extract(page.extract_text())
-                    if bill is not None:
-                        yield bill
+    files_path = list(find_pdfs(directory))
+    # A single file is not worth starting worker processes for
+    if len(files_path) < 2:
+        for file_path in files_path:
+            yield from load_pdf(file_path)
+        return
+    # One file per task, PDF sizes vary too much for larger chunks
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for bills in executor.map(load_pdf, files_path):
+            yield from bills
 
 def extract(text: str) -> dict[str, str | Any] | None:
-    if not check_text(CHECK_PATTERN, text):
+    if not check_text(CHECK_PATTERN, text, CHECK_STRINGS):
         return None
     text = substitute_text(SUBSTITUTION_PATTERNS_REPLACEMENTS, text)
     return extract_information(text) \
         | extract_consumption(text) | extract_bill(text)
 
 
+################################################################################
+# Convert, numeric columns are parsed once for all bills
+
+# Fixed per type, so outputs of different runs share one schema. float32
+# would round prices and readings such as 0.65, floats stay float64
+BILLS_DTYPES: dict[Callable, Literal["Int32", "float64"]] = {
+    int: "Int32", float: "float64"}
+
+BILLS_CONVERSIONS: dict[Callable, tuple[str, ...]] = {
+    t: tuple(dict.fromkeys(key for conversions in (
+        CONSUMPTION_非分时_CONVERSIONS, CONSUMPTION_分时_CONVERSIONS,
+        BILL_CONVERSIONS) for key in conversions.get(t, ())))
+    for t in BILLS_DTYPES}
+
+def convert_bills(bills: pandas.DataFrame) -> None:
+    for column in INFORMATION_DATES:
+        bills[column] = pandas.to_datetime(
+            bills[column], format="%Y%m%d").dt.date
+
+    for type_, columns in BILLS_CONVERSIONS.items():
+        for column in columns:
+            if column in bills:
+                bills[column] = pandas.to_numeric(
+                    bills[column]).astype(BILLS_DTYPES[type_])
+
+    # 分时 bills have no 有功总, sum up 尖峰平谷
+    if CONSUMPTION_分时_ITEMS[0]+"合计电量" in bills:
+        分时合计电量 = sum(bills[示数类型+"合计电量"]
+            for 示数类型 in CONSUMPTION_分时_ITEMS[:-1])
+        bills["有功总合计电量"] = 分时合计电量 if "有功总合计电量" not in bills \
+            else bills["有功总合计电量"].fillna(分时合计电量)
+
+
 ################################################################################
 # Save
 
 BILLS_INDICES: list[str] = [
     "用户编号", "计量点编号", "用电开始时间", "用电结束时间"]
-BILLS_FILE_NAME: str = "账单.csv"
+BILLS_FILE_NAME: str = "账单"
 
-BILLS_PIVOT: dict[str, str | tuple[str]] = {
+BILLS_PIVOT: dict[str, Any] = {
     "index": ("用电开始时间", "用电结束时间"),
     "columns": ("用户编号", "计量点编号"),
     "values": "有功总合计电量"}
-BILLS_PIVOT_FILE_NAME: str = BILLS_PIVOT["values"] + '.csv'
+BILLS_PIVOT_FILE_NAME: str = BILLS_PIVOT["values"]
+
+def save_feather(frame: pandas.DataFrame, path: str) -> None:
+    # Feather keeps neither indices nor multi-level columns
+    frame = frame.reset_index()
+    if isinstance(frame.columns, pandas.MultiIndex):
+        frame.columns = [' '.join(filter(None, map(str, column)))
+            for column in frame.columns]
+    frame.to_feather(path, compression='zstd')
+
+# Numbers Excel must read as text, leading zeros would be lost otherwise
+BILLS_APOSTROPHE_KEYS: tuple[str, ...] = ("用户编号", "结算户号", "计量点编号")
+
+def index_add_apostrophe(index: pandas.Index) -> pandas.Index:
+    if isinstance(index, pandas.MultiIndex):
+        levels = index.to_frame(index=False)
+        for key in BILLS_APOSTROPHE_KEYS:
+            if key in levels:
+                levels[key] = levels[key].map(str_add_apostrophe)
+        return pandas.MultiIndex.from_frame(levels)
+    elif index.name in BILLS_APOSTROPHE_KEYS:
+        return index.map(str_add_apostrophe)
+    else:
+        return index
+
+def save_csv(frame: pandas.DataFrame, path: str) -> None:
+    frame = frame.copy(deep=False)
+    frame.index = index_add_apostrophe(frame.index)
+    frame.columns = index_add_apostrophe(frame.columns)
+    for key in BILLS_APOSTROPHE_KEYS:
+        if key in frame.columns:
+            frame[key] = frame[key].map(str_add_apostrophe)
+    # CSV keeps the BOM so that Excel detects UTF-8
+    frame.to_csv(path, encoding='utf-8-sig')
+
+SAVE_FORMATS: dict[str, Callable[[pandas.DataFrame, str], None]] = {
+    "csv": save_csv,
+    "parquet": lambda frame, path: frame.to_parquet(
+        path, engine='pyarrow', compression='zstd'),
+    "feather": save_feather}
+
+def save(frame: pandas.DataFrame, directory: str, file_name: str,
+    format_: str
+) -> None:
+    SAVE_FORMATS[format_](
+        frame, os.path.join(directory, file_name + '.' + format_))
 
 
 ################################################################################
 # Main
 
 if __name__ == '__main__':
-    directory = sys.argv[-1] if len(sys.argv) == 2 else os.path.dirname(__file__)
-    bills = list(load(directory))
-    if bills:
-        bills = pandas.DataFrame(bills)
-        bills.set_index(BILLS_INDICES).sort_index().to_csv(
-            os.path.join(directory, BILLS_FILE_NAME), encoding='utf-8-sig')
-        pandas.pivot(bills, **BILLS_PIVOT).sort_index().to_csv(
-            os.path.join(directory, BILLS_PIVOT_FILE_NAME), encoding='utf-8-sig')
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs='?', default=os.path.dirname(__file__))
+    parser.add_argument("--format", choices=SAVE_FORMATS, default="csv")
+    arguments = parser.parse_args()
+
+    bills = pandas.DataFrame(load(arguments.directory))
+    if not bills.empty:
+        convert_bills(bills)
+        bills = bills.set_index(BILLS_INDICES).sort_index()
+        save(bills, arguments.directory, BILLS_FILE_NAME, arguments.format)
+        # Only the values column and its keys are reindexed for the pivot
+        pivot_keys = [*BILLS_PIVOT["index"], *BILLS_PIVOT["columns"]]
+        save(bills[BILLS_PIVOT["values"]].reset_index().set_index(pivot_keys)[
+            BILLS_PIVOT["values"]].unstack(list(BILLS_PIVOT["columns"]))
+            .sort_index(), arguments.directory, BILLS_PIVOT_FILE_NAME,
+            arguments.format)